@@ -1,35 +1,237 @@
 import os
+import re
+import glob
+import html
+import functools
 import json
+import queue
 import base64
-import smtplib
-from string import Template
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+import hashlib
+import tempfile
+import secrets
+import string
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
 # Load email template
-EMAIL_TEMPLATE_PATH = "templates/email_template.html"
+EMAIL_TEMPLATE_PATH = os.getenv("EMAIL_TEMPLATE_PATH", "templates/email_template.html")
+EMAIL_SUBJECT = "Your new Google Workspace account"
+# Placeholders a template may use; templates/ mixes the $name and ${givenName} spellings
+TEMPLATE_FIELDS = ("name", "email", "password", "givenName", "primaryEmail", "tempPassword", "recoveryEmail")
+
+# Environment is read once at import; require_env() checks it before any work starts
+TXT_DIR = os.getenv("TXT_DIR")
+TXT_FILE = os.getenv("TXT_FILE")
+SMTP_USER = os.getenv("EMAIL_SMTP_USER")
+SMTP_PASS = os.getenv("EMAIL_SMTP_PASS")
+
+SCOPES = ['https://www.googleapis.com/auth/admin.directory.user']
+BATCH_SIZE = 100
+# Batch requests in flight at once; keeps bulk runs under the Directory API per-user quota
+API_WORKERS = int(os.getenv("API_WORKERS", "4"))
+# Throttled inserts are resubmitted with exponential backoff (2, 4, 8, ... capped at 32 s)
+API_MAX_RETRIES = 5
+API_MAX_BACKOFF = 32
+# Legacy errors[].reason spellings plus the google.rpc.ErrorInfo reason found under details[]
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded", "quotaExceeded", "RATE_LIMIT_EXCEEDED"}
+API_TIMEOUT = 60
+# A whole batch rejected with one of these is resent after 0.5, 1, 2, ... seconds
+API_RETRY_STATUSES = {500, 502, 503, 504}
+API_BATCH_RETRIES = 3
+REQUIRED_FIELDS = ("primaryEmail", "givenName", "EmailToSendCred")
+EMAIL_FIELDS = ("primaryEmail", "EmailToSendCred", "recoveryEmail")
+NAME_FIELDS = ("givenName", "familyName")
+# Directory API limit for givenName and familyName
+MAX_NAME_LENGTH = 60
+# Below this many files, starting worker processes costs more than parsing inline
+PARALLEL_PARSE_MIN_FILES = 1000
+TOKEN_CACHE_DIR = os.path.join(os.getenv("XDG_CACHE_HOME") or tempfile.gettempdir(), "bulkgooglegen")
+# Google access tokens live ~1h; only reuse a cached one with at least this much left
+TOKEN_CACHE_MARGIN = timedelta(minutes=5)
+REFRESH_TOKEN_CACHE = os.getenv("REFRESH_TOKEN_CACHE") == "1"
+# Parsed once per process instead of on every load_creds() call. An unset GitHub secret
+# arrives as "", so empty or malformed JSON is left for require_env() to report
+try:
+    _TOKEN_INFO = json_loads(os.getenv("TOKEN_JSON") or "null")
+except ValueError:
+    _TOKEN_INFO = None
+SMTP_WORKERS = int(os.getenv("SMTP_WORKERS", "5"))
+SMTP_TIMEOUT = 30
+# Gmail starts deferring long-lived sessions; reconnect after this many messages
+SMTP_MAX_MESSAGES = 100
+# A session idle for longer than this is probed with NOOP before it is reused
+SMTP_IDLE_CHECK = 60
+SMTP_NOOP_TIMEOUT = 5
+
+# httplib2 is not thread-safe, so each API worker thread gets its own authorized client
+_api_local = threading.local()
+_service = None
+_service_lock = threading.Lock()
+
+_EOL_RE = re.compile(rb"\r\n|\r|\n")
+# RFC 5322 line limit; HTML with longer lines is sent base64-encoded instead of 7bit
+_MAX_LINE_LENGTH = 998
 
+PASSWORD_LENGTH = 12
+_PASSWORD_ALPHABET = (string.ascii_letters + string.digits + string.punctuation).encode()
+# Bytes past the last whole multiple of the alphabet are deleted so every character is equally likely
+_PASSWORD_LIMIT = 256 - 256 % len(_PASSWORD_ALPHABET)
+_PASSWORD_TABLE = bytes(_PASSWORD_ALPHABET[i % len(_PASSWORD_ALPHABET)] for i in range(256))
+_PASSWORD_REJECT = bytes(range(_PASSWORD_LIMIT, 256))
+
+# "key: value" lines; blank lines, lines without a colon and "#" comments never match
+_TXT_LINE_RE = re.compile(r"(?m)^[ \t]*([^#\s][^:\r\n]*?)[ \t]*:[ \t]*(.*?)[ \t\r]*$")
+# A line of just "---" separates user blocks inside one TXT file
+_TXT_SEPARATOR_RE = re.compile(r"(?m)^[ \t]*---[ \t\r]*$")
+# Printable ASCII except "@"; smtplib cannot put a non-ASCII address in RCPT TO
+_EMAIL_RE = re.compile(r"[!-?A-~]+@[!-?A-~]+\.[!-?A-~]+")
+
+# string.Template placeholders ($name, ${name}, $$) plus literal braces that str.format would misread
+_TEMPLATE_TOKEN_RE = re.compile(r"\$\$|\$(\w+)|\$\{(\w+)\}|\{|\}")
+
+def _to_format_field(match):
+    token = match.group(0)
+    if token == "$$":
+        return "$"
+    if token in "{}":
+        return token * 2
+    return "{" + (match.group(1) or match.group(2)) + "}"
+
+@functools.lru_cache(maxsize=4)
 def load_template(path):
+    # Read and convert once so each render is a single C-level str.format_map
     with open(path, "r", encoding="utf-8") as f:
-        return Template(f.read())
-
-def parse_txt(file_path):
-    with open(file_path, 'r') as f:
-        lines = [line.strip() for line in f.readlines() if line.strip() and ':' in line]
-    data = {}
-    for line in lines:
-        key, value = map(str.strip, line.split(':', 1))
-        data[key] = value
-    return data
-
-def create_user(service, user_info, password):
+        template = _TEMPLATE_TOKEN_RE.sub(_to_format_field, f.read())
+
+    unknown = {field for _, field, _, _ in string.Formatter().parse(template) if field} - set(TEMPLATE_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown placeholders in {path}: {', '.join(sorted(unknown))}")
+    return template
+
+def render_email(email_template, user_info, password):
+    # Generated passwords may contain HTML metacharacters such as < and &
+    name = html.escape(user_info["givenName"])
+    email = html.escape(user_info["primaryEmail"])
+    password = html.escape(password)
+    return email_template.format_map({
+        "name": name,
+        "email": email,
+        "password": password,
+        "givenName": name,
+        "primaryEmail": email,
+        "tempPassword": password,
+        "recoveryEmail": html.escape(user_info.get("recoveryEmail", "")),
+    })
+
+def require_env():
+    required = {"TOKEN_JSON": isinstance(_TOKEN_INFO, dict), "EMAIL_SMTP_USER": SMTP_USER, "EMAIL_SMTP_PASS": SMTP_PASS}
+    missing = [name for name, value in required.items() if not value]
+    if missing:
+        raise RuntimeError(f"Missing or invalid environment variables: {', '.join(missing)}")
+
+def load_creds():
+    # The Google auth stack is imported only once a run actually needs credentials
+    import httplib2
+    from google.oauth2.credentials import Credentials
+    from google_auth_httplib2 import Request
+
+    if not isinstance(_TOKEN_INFO, dict):
+        raise RuntimeError("TOKEN_JSON is not set or is not a JSON object")
+    token_info = _TOKEN_INFO
+    key = hashlib.sha256(token_info["refresh_token"].encode()).hexdigest()[:16]
+    cache_path = os.path.join(TOKEN_CACHE_DIR, f"token_{key}.json")
+
+    if not REFRESH_TOKEN_CACHE:
+        try:
+            with open(cache_path, "rb") as f:
+                cached = json_loads(f.read())
+            creds = Credentials.from_authorized_user_info({**token_info, **cached}, SCOPES)
+            if creds.expiry - datetime.now(timezone.utc).replace(tzinfo=None) > TOKEN_CACHE_MARGIN:
+                return creds
+        except (OSError, ValueError, KeyError):
+            pass
+
+    creds = Credentials.from_authorized_user_info(token_info, SCOPES)
+    creds.refresh(Request(httplib2.Http()))
+
+    # Only the short-lived access token is cached, never the refresh token or client secret
+    os.makedirs(TOKEN_CACHE_DIR, mode=0o700, exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w", encoding="utf-8") as f:
+        json.dump({"token": creds.token, "expiry": creds.expiry.isoformat()}, f)
+    os.replace(tmp_path, cache_path)
+    return creds
+
+def find_txt_files():
+    if TXT_DIR:
+        pattern = os.path.join(TXT_DIR, "*.txt") if os.path.isdir(TXT_DIR) else TXT_DIR
+        txt_files = sorted(glob.glob(pattern))
+        if not txt_files:
+            raise FileNotFoundError(f"No TXT files found at: {TXT_DIR}")
+        return txt_files
+
+    if not TXT_FILE or not os.path.exists(TXT_FILE):
+        raise FileNotFoundError(f"No TXT file found at: {TXT_FILE}")
+    return [TXT_FILE]
+
+def parse_block(text):
+    # findall() yields (key, value) tuples, so dict() builds the record without a Python-level loop
+    return dict(_TXT_LINE_RE.findall(text))
+
+def parse_txt_many(file_path):
+    with open(file_path, "r", encoding="utf-8-sig") as f:
+        blocks = _TXT_SEPARATOR_RE.split(f.read())
+    return [user_info for user_info in map(parse_block, blocks) if user_info]
+
+def validate(user_info):
+    # Rows the API would reject are caught here so they cost no round-trip or quota
+    problems = [f"missing {field}" for field in REQUIRED_FIELDS if not user_info.get(field)]
+    problems += [
+        f"invalid {field}" for field in EMAIL_FIELDS
+        if user_info.get(field) and not _EMAIL_RE.fullmatch(user_info[field])
+    ]
+    problems += [
+        f"{field} longer than {MAX_NAME_LENGTH} characters" for field in NAME_FIELDS
+        if len(user_info.get(field, "")) > MAX_NAME_LENGTH
+    ]
+    if user_info.get("orgUnitPath") and not user_info["orgUnitPath"].startswith("/"):
+        problems.append("orgUnitPath must start with /")
+    return problems
+
+def load_request(file_path):
+    users = parse_txt_many(file_path)
+    # A file of only comments or "key = value" lines would otherwise pass as an empty, green run
+    if not users:
+        raise ValueError(f"No user blocks found in: {file_path}")
+    return [(user_info, validate(user_info)) for user_info in users]
+
+def load_requests(txt_files):
+    if len(txt_files) < PARALLEL_PARSE_MIN_FILES:
+        per_file = map(load_request, txt_files)
+    else:
+        with ProcessPoolExecutor() as pool:
+            per_file = list(pool.map(load_request, txt_files, chunksize=32))
+    return [request for requests in per_file for request in requests]
+
+def generate_password(length=PASSWORD_LENGTH):
+    password = b""
+    while len(password) < length:
+        password += secrets.token_bytes(length * 2).translate(_PASSWORD_TABLE, _PASSWORD_REJECT)
+    return password[:length].decode("ascii")
+
+def build_user_body(user_info, password):
     user_body = {
         "primaryEmail": user_info["primaryEmail"],
         "name": {
             "givenName": user_info["givenName"],
-            "familyName": user_info.get("familyName", "User")
+            "familyName": user_info.get("familyName") or "User"
         },
         "password": password,
         "changePasswordAtNextLogin": True
@@ -42,49 +244,413 @@ def create_user(service, user_info, password):
     if user_info.get("orgUnitPath"):
         user_body["orgUnitPath"] = user_info["orgUnitPath"]
 
-    return service.users().insert(body=user_body).execute()
+    return user_body
 
-def send_email(smtp_user, smtp_pass, to_email, subject, html_content):
-    msg = MIMEMultipart("alternative")
-    msg["Subject"] = subject
-    msg["From"] = smtp_user
-    msg["To"] = to_email
+def get_api_http(creds):
+    import httplib2
+    from google_auth_httplib2 import AuthorizedHttp
 
-    part2 = MIMEText(html_content, "html")
-    msg.attach(part2)
+    # httplib2 keeps one connection per host alive, so a thread's batches share a TLS session
+    http = getattr(_api_local, "http", None)
+    if http is None:
+        http = AuthorizedHttp(creds, http=httplib2.Http(timeout=API_TIMEOUT))
+        _api_local.http = http
+    return http
 
-    with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
-        server.login(smtp_user, smtp_pass)
-        server.sendmail(smtp_user, to_email, msg.as_string())
+def get_service(creds):
+    # Built once per process: the bundled discovery document avoids a network fetch,
+    # and batches run on per-thread clients, so one Resource serves every call
+    from googleapiclient.discovery import build
 
-def main():
-    txt_file = os.getenv("TXT_FILE")
-    if not txt_file or not os.path.exists(txt_file):
-        raise FileNotFoundError(f"No TXT file found at: {txt_file}")
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = build(
+                'admin', 'directory_v1', http=get_api_http(creds),
+                cache_discovery=False, static_discovery=True
+            )
+    return _service
 
-    user_info = parse_txt(txt_file)
-    creds = Credentials.from_authorized_user_info(json.loads(os.getenv("TOKEN_JSON")), [
-        'https://www.googleapis.com/auth/admin.directory.user']
+def is_rate_limited(error):
+    from googleapiclient.errors import HttpError
+
+    if not isinstance(error, HttpError):
+        return False
+    if error.status_code == 429:
+        return True
+    # 403 is also used for permission errors, which must not be retried. HttpError takes
+    # error_details from "details" when the body has it and falls back to "errors"
+    details = error.error_details if isinstance(error.error_details, list) else []
+    return error.status_code == 403 and any(
+        isinstance(detail, dict) and detail.get("reason") in RATE_LIMIT_REASONS for detail in details
     )
-    service = build('admin', 'directory_v1', credentials=creds)
 
-    password = base64.urlsafe_b64encode(os.urandom(8)).decode("utf-8")
-    user = create_user(service, user_info, password)
+def confirm_created(service, users, creds, uncertain, since):
+    import httplib2
+    from googleapiclient.errors import HttpError
 
-    email_template = load_template(EMAIL_TEMPLATE_PATH)
-    email_html = email_template.substitute(
-        name=user_info["givenName"],
-        email=user_info["primaryEmail"],
-        password=password
-    )
+    # Looks up each account whose insert may have run without a reply. Only accounts newer
+    # than this run were created by it; older ones already existed and are plain failures
+    unsent, unknown, failed = [], [], []
+    errors = dict(uncertain)
+
+    def on_lookup(request_id, response, exception):
+        if exception is None:
+            if datetime.fromisoformat(response["creationTime"].replace("Z", "+00:00")) >= since:
+                unsent.append((request_id, RuntimeError(
+                    "created by a batch attempt that got no clean reply; its password was never sent"
+                )))
+            else:
+                failed.append((request_id, errors[request_id]))
+        elif getattr(exception, "status_code", None) == 404:
+            failed.append((request_id, errors[request_id]))
+        else:
+            unknown.append((request_id, exception))
+
+    emails = list(errors)
+    for start in range(0, len(emails), BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=on_lookup)
+        for email in emails[start:start + BATCH_SIZE]:
+            batch.add(users.get(userKey=email, fields="creationTime"), request_id=email)
+        try:
+            batch.execute(http=get_api_http(creds))
+        except (HttpError, httplib2.HttpLib2Error, OSError) as e:
+            unknown.extend((email, e) for email in emails[start:start + BATCH_SIZE])
+
+    return unsent, unknown, failed
+
+def create_users(service, creds, pending, on_created=None):
+    created, failed, uncertain, throttled = [], [], [], []
+    since = datetime.now(timezone.utc)
+    by_email = {user_info["primaryEmail"]: (user_info, password) for user_info, password in pending}
+
+    def on_user_created(can_retry, resent, request_id, response, exception):
+        user_info, password = by_email[request_id]
+        if exception is not None:
+            if resent and getattr(exception, "status_code", None) == 409:
+                # The 5xx that caused the resend can arrive after the backend already ran this
+                # insert, but the account may equally have existed before the run
+                uncertain.append((user_info["primaryEmail"], exception))
+            elif can_retry and is_rate_limited(exception):
+                throttled.append((user_info, password))
+            else:
+                failed.append((user_info["primaryEmail"], exception))
+            return
+        created.append((user_info, password))
+        if on_created is not None:
+            on_created(user_info, password)
+
+    # service.users() rebuilds the resource from the discovery document (~0.7 ms a call),
+    # so it is built once here rather than once per user
+    users = service.users()
+
+    def run_batch(chunk, can_retry):
+        import httplib2
+        from googleapiclient.errors import BatchError, HttpError
+
+        for retry in range(API_BATCH_RETRIES + 1):
+            callback = functools.partial(on_user_created, can_retry, retry > 0)
+            batch = service.new_batch_http_request(callback=callback)
+            for user_info, password in chunk:
+                batch.add(
+                    users.insert(body=build_user_body(user_info, password)),
+                    request_id=user_info["primaryEmail"]
+                )
+            try:
+                batch.execute(http=get_api_http(creds))
+                return
+            except BatchError as e:
+                # Subclasses HttpError but may carry no response, so it is never retried
+                error, may_have_run = e, retry > 0
+            except HttpError as e:
+                # A non-2xx batch response arrives before any sub-response is handled
+                error, may_have_run = e, retry > 0 or e.status_code >= 500
+                if retry < API_BATCH_RETRIES and e.status_code in API_RETRY_STATUSES:
+                    time.sleep(0.5 * 2 ** retry)
+                    continue
+            except (httplib2.HttpLib2Error, OSError) as e:
+                # A timeout or reset can come after the request was sent; a DNS failure cannot
+                error, may_have_run = e, retry > 0 or isinstance(e, OSError)
+            # Other batches keep going so the report still lists what they created
+            (uncertain if may_have_run else failed).extend(
+                (user_info["primaryEmail"], error) for user_info, _ in chunk
+            )
+            return
 
-    send_email(
-        smtp_user=os.getenv("EMAIL_SMTP_USER"),
-        smtp_pass=os.getenv("EMAIL_SMTP_PASS"),
-        to_email=user_info["EmailToSendCred"],
-        subject="Your new Google Workspace account",
-        html_content=email_html
+    for attempt in range(API_MAX_RETRIES + 1):
+        if attempt:
+            time.sleep(min(2 ** attempt, API_MAX_BACKOFF))
+        # Admin SDK accepts at most BATCH_SIZE calls per batch request
+        chunks = [pending[start:start + BATCH_SIZE] for start in range(0, len(pending), BATCH_SIZE)]
+        with ThreadPoolExecutor(max_workers=API_WORKERS) as pool:
+            for future in [pool.submit(run_batch, chunk, attempt < API_MAX_RETRIES) for chunk in chunks]:
+                future.result()
+        if not throttled:
+            break
+        pending, throttled = throttled, []
+
+    unsent, unknown = [], []
+    if uncertain:
+        unsent, unknown, confirmed_failed = confirm_created(service, users, creds, uncertain, since)
+        failed.extend(confirmed_failed)
+    return created, failed, unsent, unknown
+
+def open_smtp(smtp_user, smtp_pass):
+    import smtplib
+
+    server = smtplib.SMTP_SSL("smtp.gmail.com", 465, timeout=SMTP_TIMEOUT)
+    server.login(smtp_user, smtp_pass)
+    return server
+
+class SmtpSession:
+    def __init__(self, smtp_user, smtp_pass):
+        self.smtp_user = smtp_user
+        self.smtp_pass = smtp_pass
+        self.server = None
+        self.last_ok = 0.0
+        self.sent = 0
+
+    def connect(self):
+        self.close()
+        self.server = open_smtp(self.smtp_user, self.smtp_pass)
+        self.last_ok = time.monotonic()
+        self.sent = 0
+
+    def ensure_alive(self):
+        # smtplib.close() after a socket error leaves the server object with sock set to None
+        if self.server is None or self.server.sock is None or self.sent >= SMTP_MAX_MESSAGES:
+            self.connect()
+            return
+        if time.monotonic() - self.last_ok <= SMTP_IDLE_CHECK:
+            return
+
+        # An idle-closed socket would otherwise stall the next send until SMTP_TIMEOUT
+        try:
+            self.server.sock.settimeout(SMTP_NOOP_TIMEOUT)
+            alive = self.server.noop()[0] == 250
+            self.server.sock.settimeout(SMTP_TIMEOUT)
+        except OSError:
+            alive = False
+        if alive:
+            self.last_ok = time.monotonic()
+        else:
+            self.connect()
+
+    def send(self, to_email, subject, html_content):
+        import smtplib
+
+        self.ensure_alive()
+        try:
+            send_email(self.server, self.smtp_user, to_email, subject, html_content)
+        except smtplib.SMTPServerDisconnected:
+            # Dropped between the liveness check and the send; retry once on a fresh session
+            self.connect()
+            send_email(self.server, self.smtp_user, to_email, subject, html_content)
+        self.last_ok = time.monotonic()
+        self.sent += 1
+
+    def close(self):
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except OSError:
+            self.server.close()
+        self.server = None
+
+class SMTPPool:
+    def __init__(self, smtp_user, smtp_pass, max_size=SMTP_WORKERS):
+        self.smtp_user = smtp_user
+        self.smtp_pass = smtp_pass
+        self.max_size = max_size
+        # LIFO hands out the most recently used session, which is the least likely to be idle-closed
+        self.idle = queue.LifoQueue()
+        self.sessions = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if len(self.sessions) < self.max_size:
+                session = SmtpSession(self.smtp_user, self.smtp_pass)
+                self.sessions.append(session)
+                return session
+        return self.idle.get()
+
+    def release(self, session):
+        self.idle.put(session)
+
+    def send(self, to_email, subject, html_content):
+        session = self.acquire()
+        try:
+            session.send(to_email, subject, html_content)
+        finally:
+            self.release(session)
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions:
+                session.close()
+
+@functools.lru_cache(maxsize=8)
+def message_headers(smtp_user, subject):
+    from email.policy import SMTP as SMTP_POLICY
+
+    # Only To and the body change between credential emails, so the rest is encoded once
+    headers = "".join(
+        SMTP_POLICY.header_factory(name, value).fold(policy=SMTP_POLICY)
+        for name, value in (("From", smtp_user), ("Subject", subject))
     )
+    return headers.encode("ascii") + b'MIME-Version: 1.0\r\nContent-Type: text/html; charset="utf-8"\r\n'
+
+def send_email(server, smtp_user, to_email, subject, html_content):
+    # Line endings are normalized once for the whole message in pipelined_sendmail()
+    body = html_content.encode("utf-8")
+    # Non-ASCII (e.g. a name like "Zoë") is base64-encoded, as MAIL FROM never declares BODY=8BITMIME
+    if not html_content.isascii() or any(len(line) > _MAX_LINE_LENGTH for line in body.splitlines()):
+        encoding, body = b"base64", base64.encodebytes(body)
+    else:
+        encoding = b"7bit"
+
+    msg = b"".join((
+        f"To: {to_email}\r\n".encode("utf-8"),
+        message_headers(smtp_user, subject),
+        b"Content-Transfer-Encoding: ", encoding, b"\r\n\r\n",
+        body,
+    ))
+    pipelined_sendmail(server, smtp_user, [to_email], msg)
+
+def pipelined_sendmail(server, from_addr, to_addrs, msg):
+    import smtplib
+
+    msg = _EOL_RE.sub(b"\r\n", msg)
+    if not server.has_extn("pipelining"):
+        return server.sendmail(from_addr, to_addrs, msg)
+
+    # RFC 2920: MAIL, RCPT and DATA go out in one write and their replies are
+    # read back together, so the envelope costs one round-trip instead of three
+    commands = [f"MAIL FROM:{smtplib.quoteaddr(from_addr)}"]
+    commands += [f"RCPT TO:{smtplib.quoteaddr(addr)}" for addr in to_addrs]
+    commands.append("DATA")
+    server.send("".join(command + "\r\n" for command in commands))
+    replies = [server.getreply() for _ in commands]
+
+    (mail_code, mail_resp), data_reply = replies[0], replies[-1]
+    refused = {
+        addr: reply for addr, reply in zip(to_addrs, replies[1:-1])
+        if reply[0] not in (250, 251)
+    }
+
+    if data_reply[0] == 354 and (mail_code != 250 or len(refused) == len(to_addrs)):
+        # The server is waiting for a body we no longer want to deliver
+        server.send(b".\r\n")
+        server.getreply()
+    if mail_code != 250:
+        server._rset()
+        raise smtplib.SMTPSenderRefused(mail_code, mail_resp, from_addr)
+    if len(refused) == len(to_addrs):
+        server._rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+    if data_reply[0] != 354:
+        server._rset()
+        raise smtplib.SMTPDataError(*data_reply)
+
+    # Dot-stuffing with bytes.replace avoids another regex pass over the message
+    data = msg.replace(b"\r\n.", b"\r\n..")
+    server.send(b"".join((
+        b"." if data.startswith(b".") else b"",
+        data,
+        b"" if data.endswith(b"\r\n") else b"\r\n",
+        b".\r\n",
+    )))
+    code, resp = server.getreply()
+    if code != 250:
+        server._rset()
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+def send_credentials(smtp_pool, email_template, user_info, password):
+    email_html = render_email(email_template, user_info, password)
+    smtp_pool.send(user_info["EmailToSendCred"], EMAIL_SUBJECT, email_html)
+
+def describe_error(error):
+    from googleapiclient.errors import BatchError, HttpError
+
+    if isinstance(error, BatchError):
+        return f"Batch Error: {error.reason}"
+    # HttpError already parses the response body; it also copes with non-JSON 5xx pages
+    if isinstance(error, HttpError):
+        return f"API Error {error.status_code}: {error.reason}; details={error.error_details}"
+    return repr(error)
+
+def report(sent, unsent, unknown, failed, total):
+    for email in sent:
+        print(f"Created {email}")
+    # These accounts exist, so re-running would only get a 409; their password must be reset by hand
+    for email, error in unsent:
+        print(f"Created {email} but credentials were not sent: {describe_error(error)}")
+    for email, error in unknown:
+        print(f"Unconfirmed {email}: may have been created, check the Admin console: {describe_error(error)}")
+    for email, error in failed:
+        print(f"Failed {email}: {describe_error(error)}")
+    if unsent or unknown or failed:
+        raise SystemExit(
+            f"{len(failed)} of {total} user(s) failed, {len(unsent)} created without credentials sent, "
+            f"{len(unknown)} unconfirmed"
+        )
+
+def main():
+    require_env()
+    email_template = load_template(EMAIL_TEMPLATE_PATH)
+    users = load_requests(find_txt_files())
+
+    # Reject malformed requests before any OAuth refresh or API connection is made
+    pending, failed, seen = [], [], set()
+    for user_info, problems in users:
+        email = user_info.get("primaryEmail")
+        if problems:
+            failed.append((email, ValueError("; ".join(problems))))
+            continue
+        if email in seen:
+            failed.append((email, ValueError("duplicate primaryEmail in this run")))
+            continue
+        seen.add(email)
+        pending.append((user_info, generate_password()))
+    if not pending:
+        report([], [], [], failed, len(users))
+        return
+
+    creds = load_creds()
+    service = get_service(creds)
+
+    # Emails for one batch go out on the SMTP pool while other batches are still in flight
+    futures = []
+    smtp_pool = SMTPPool(SMTP_USER, SMTP_PASS)
+    try:
+        with ThreadPoolExecutor(max_workers=SMTP_WORKERS) as pool:
+            def notify(user_info, password):
+                future = pool.submit(send_credentials, smtp_pool, email_template, user_info, password)
+                futures.append((user_info["primaryEmail"], future))
+
+            _, create_failed, create_unsent, unknown = create_users(service, creds, pending, on_created=notify)
+            failed.extend(create_failed)
+    finally:
+        smtp_pool.close()
+
+    sent, unsent = [], create_unsent
+    for email, future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            # The account already exists, so one bad send must not hide the rest of the report
+            unsent.append((email, e))
+            continue
+        sent.append(email)
+
+    report(sent, unsent, unknown, failed, len(users))
 
 if __name__ == "__main__":
     main()